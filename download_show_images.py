@@ -1,69 +1,195 @@
 import os
-import json
-import requests
+import orjson
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from urllib.parse import urlparse
 from io import BytesIO
-from PIL import Image, ImageOps
+from PIL import Image
 
 BASE_UPLOAD_URL = "https://programaciontv.com.mx/wp-content/uploads/downloaded-images"
 FALLBACK_REPLACEMENT = "https://programaciontv.com.mx/wp-content/uploads/2026/01/pexels-caleboquendo-8254900.webp"
-MAX_THREADS = 15
+MAX_CONCURRENT_DOWNLOADS = 30
+MAX_CONNECTIONS = 64
 TIMEOUT = 20
 ROOT_DIR = os.getcwd()
 SCHEDULE_DIR = os.path.join(ROOT_DIR, "schedule")
 DOWNLOAD_DIR = os.path.join(ROOT_DIR, "downloaded-images")
 HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
 
+# Output thumbnail size and byte budget
+THUMB_SIZE = (300, 203)
+MAX_SIZE_BYTES = 10 * 1024
+# Decode JPEGs at no less than twice the thumbnail size
+DRAFT_SIZE = (THUMB_SIZE[0] * 2, THUMB_SIZE[1] * 2)
+
+# Box-reduce large sources before LANCZOS; 3.0 is visually indistinguishable
+REDUCING_GAP = 3.0
+
+# WEBP quality search bounds
+MIN_QUALITY = 20
+MAX_QUALITY = 85
+QUALITY_STEP = 5
+SIZE_TOLERANCE = 0.025
+# libwebp effort: fast while searching, densest for the one encode we keep
+SEARCH_METHOD = 0
+FINAL_METHOD = 6
+# FINAL_METHOD output runs ~8-10% smaller than SEARCH_METHOD at the same quality
+FINAL_METHOD_GAIN = 0.10
+
+_SLUG_STRIP = re.compile(r'[^\w\s-]')
+_SLUG_DASH = re.compile(r'[\s_-]+')
+
+@lru_cache(maxsize=4096)
 def slugify(text):
     """Converts 'Peppa Pig' to 'peppa-pig'"""
     text = text.lower().strip()
-    text = re.sub(r'[^\w\s-]', '', text)
-    return re.sub(r'[\s_-]+', '-', text)
+    text = _SLUG_STRIP.sub('', text)
+    return _SLUG_DASH.sub('-', text)
+
+def fit_thumbnail(image):
+    """
+    Center-crops to the THUMB_SIZE aspect ratio and resizes, like ImageOps.fit,
+    but lets Pillow shrink big sources with a cheap box reduce first.
+    """
+    width, height = image.size
+    target_width, target_height = THUMB_SIZE
+    scale = min(width / target_width, height / target_height)
+    crop_width, crop_height = target_width * scale, target_height * scale
+    left = (width - crop_width) / 2
+    top = (height - crop_height) / 2
+    box = (left, top, left + crop_width, top + crop_height)
+    return image.resize(THUMB_SIZE, Image.Resampling.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+
+def encode_webp(image, quality, buffer, method=SEARCH_METHOD):
+    """Encodes into a reused buffer from offset 0 and returns the encoded size."""
+    buffer.seek(0)
+    image.save(buffer, "WEBP", quality=quality, method=method, exif=b"", icc_profile=None)
+    return buffer.tell()
 
-def download_and_convert(task):
-    url, save_path = task
+def compress_webp(image, max_size_bytes):
+    """
+    Binary searches the WEBP quality so the result stays under max_size_bytes.
+    The search runs at the fast encoder method and the result is re-encoded
+    at FINAL_METHOD, which is denser: a near miss at MAX_QUALITY and one
+    QUALITY_STEP above the search winner get a FINAL_METHOD try first.
+    Returns (buffer, size) for the highest quality that fits (MIN_QUALITY if
+    none does); only buffer[:size] is valid.
+    """
+    # Two buffers are swapped between attempts so neither has to regrow
+    buffer, spare = BytesIO(), BytesIO()
+    size = encode_webp(image, MAX_QUALITY, buffer)
+    if size <= max_size_bytes:
+        return buffer, size
+    # Highest quality not yet known to miss at FINAL_METHOD
+    final_ceiling = MAX_QUALITY
+    if size <= max_size_bytes * (1 + FINAL_METHOD_GAIN):
+        size = encode_webp(image, MAX_QUALITY, spare, method=FINAL_METHOD)
+        if size <= max_size_bytes:
+            return spare, size
+        final_ceiling = MAX_QUALITY - 1
+
+    best_size = None
+    best_quality = MIN_QUALITY
+    lo, hi = MIN_QUALITY, MAX_QUALITY
+    while hi - lo > QUALITY_STEP:
+        mid = (hi + lo) // 2
+        size = encode_webp(image, mid, spare)
+        if size <= max_size_bytes:
+            buffer, spare = spare, buffer
+            best_size = size
+            best_quality = mid
+            lo = mid
+            # Close enough to the target, another encode won't buy much
+            if size >= max_size_bytes * (1 - SIZE_TOLERANCE):
+                break
+        else:
+            hi = mid
+
+    step_up = min(best_quality + QUALITY_STEP, final_ceiling)
+    if best_size is not None and step_up > best_quality:
+        size = encode_webp(image, step_up, spare, method=FINAL_METHOD)
+        if size <= max_size_bytes:
+            return spare, size
+
+    final_size = encode_webp(image, best_quality, spare, method=FINAL_METHOD)
+    if best_size is None or final_size <= best_size:
+        return spare, final_size
+    return buffer, best_size
+
+def is_ready_webp(data, content_type):
+    """True if the source is already a metadata-free WEBP thumbnail within budget."""
+    if len(data) > MAX_SIZE_BYTES:
+        return False
+    if "webp" not in content_type.lower() and data[8:12] != b"WEBP":
+        return False
     try:
-        r = requests.get(url, timeout=TIMEOUT, headers=HEADERS)
-        r.raise_for_status()
-        
-        # Open image and strip metadata by creating a fresh copy
-        with Image.open(BytesIO(r.content)) as img:
-            # Clean metadata and convert to RGB
-            image = Image.new("RGB", img.size)
-            image.paste(img)
-
-            # Step 3: Crop/Resize to 300x203
-            # ImageOps.fit crops to the exact aspect ratio without stretching
-            image = ImageOps.fit(image, (300, 203), Image.Resampling.LANCZOS)
-            
-            # Compress to keep under 10 KB
-            max_size_bytes = 10 * 1024
-            quality = 85
-            
-            while quality >= 20:
-                buffer = BytesIO()
-                image.save(buffer, "WEBP", quality=quality, method=6)
-                if buffer.tell() <= max_size_bytes:
-                    break
-                quality -= 10
-            
+        # Only reads the header, no pixel decode
+        with Image.open(BytesIO(data)) as img:
+            return (
+                img.format == "WEBP"
+                and img.size == THUMB_SIZE
+                and not getattr(img, "is_animated", False)
+                and not img.info.get("exif")
+                and not img.info.get("icc_profile")
+            )
+    except Exception:
+        return False
+
+def encode_and_save(data, save_path):
+    """Runs in a worker process: decode, crop/resize and write the WEBP."""
+    with Image.open(BytesIO(data)) as img:
+        # JPEGs can be DCT-scaled on load; no-op for other formats
+        img.draft("RGB", DRAFT_SIZE)
+
+        # Convert to RGB in one pass; metadata is dropped at save time
+        image = img.convert("RGB")
+
+    # Step 3: Crop/Resize to 300x203
+    # Crops to the exact aspect ratio without stretching
+    image = fit_thumbnail(image)
+    
+    # Compress to keep under 10 KB
+    buffer, size = compress_webp(image, MAX_SIZE_BYTES)
+    
+    with open(save_path, "wb") as f:
+        f.write(buffer.getbuffer()[:size])
+
+async def fetch(session, semaphore, pool, url, save_path):
+    try:
+        async with semaphore:
+            async with session.get(url) as r:
+                r.raise_for_status()
+                data = await r.read()
+                content_type = r.headers.get("Content-Type", "")
+
+        # Already optimized upstream, keep the bytes as they are
+        if is_ready_webp(data, content_type):
             with open(save_path, "wb") as f:
-                f.write(buffer.getvalue())
-                
+                f.write(data)
+            return True, url
+
+        # PIL work is CPU bound, hand it to the process pool to get around the GIL
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(pool, encode_and_save, data, save_path)
         return True, url
     except Exception as e:
         print(f"Error processing {url}: {e}")
         return False, url
 
-def process_json(json_path, day):
+async def process_json(session, semaphore, pool, json_path, day):
     channel_slug = os.path.splitext(os.path.basename(json_path))[0]
     output_dir = os.path.join(DOWNLOAD_DIR, channel_slug, day)
     os.makedirs(output_dir, exist_ok=True)
     
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    # One directory listing instead of a stat per show
+    with os.scandir(output_dir) as entries:
+        existing = {entry.name for entry in entries}
+    
+    with open(json_path, "rb") as f:
+        data = orjson.loads(f.read())
     
     download_tasks = []
     
@@ -86,26 +212,44 @@ def process_json(json_path, day):
         # Replace the URL in JSON
         show["show_logo"] = f"{BASE_UPLOAD_URL}/{channel_slug}/{day}/{filename}"
         
-        if not os.path.exists(local_path):
+        # Repeated titles share one file, queue each only once
+        if filename not in existing:
+            existing.add(filename)
             download_tasks.append((logo_url, local_path))
     
     if download_tasks:
-        with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-            futures = [executor.submit(download_and_convert, t) for t in download_tasks]
-            for _ in as_completed(futures):
-                pass
+        await asyncio.gather(
+            *(fetch(session, semaphore, pool, url, save_path) for url, save_path in download_tasks)
+        )
     
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # Write next to the original and swap it in, readers never see a partial file
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, json_path)
+
+async def run(json_files, pool):
+    # One session and one in-flight cap shared by every channel file
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout) as session:
+        await asyncio.gather(
+            *(process_json(session, semaphore, pool, json_path, day) for json_path, day in json_files)
+        )
 
 def main():
+    json_files = []
     for day in ["today", "tomorrow"]:
         day_dir = os.path.join(SCHEDULE_DIR, day)
         if not os.path.isdir(day_dir):
             continue
         for file in os.listdir(day_dir):
             if file.endswith(".json"):
-                process_json(os.path.join(day_dir, file), day)
+                json_files.append((os.path.join(day_dir, file), day))
+
+    with ProcessPoolExecutor() as pool:
+        asyncio.run(run(json_files, pool))
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,25 @@
-import requests
-from bs4 import BeautifulSoup
+import argparse
+import asyncio
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from selectolax.lexbor import LexborHTMLParser
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import os
-import json
-import re
+from pathlib import Path
+import time
+import sys
+import logging
+from logging.handlers import MemoryHandler
+import orjson
+from dataclasses import dataclass
 
 # --- CONFIGURATION ---
 CHANNEL_FILE = "channel.txt"
 LOG_FILE = "epg.log"
 OUTPUT_DIR = "schedule"
-TIMEZONE = pytz.timezone('America/Sao_Paulo')
+TIMEZONE = ZoneInfo('America/Sao_Paulo')
 
 # User provided URL structure with placeholder for channel slug
 # NOTE: The ID '330' might be specific to Food Network. 
@@ -21,93 +30,269 @@ URL_TEMPLATES = {
     "tomorrow":  "https://mi.tv/mx/async/channel/{slug}/manana/-360"
 }
 
+# The trailing -360 asks mi.tv for UTC-6 listings, so its days roll over at UTC-6 midnight
+SITE_TIMEZONE = datetime.timezone(datetime.timedelta(minutes=-360))
+
 # HTTP Headers to mimic a browser (avoids some bot blocking)
+# Accept-Encoding is left to aiohttp: it sends "gzip, deflate" and adds "br"
+# whenever Brotli is installed, so it never asks for a coding it can't decode
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
     "Accept-Language": "pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7"
 }
 
-def log(message):
-    """Writes to the log file and console."""
-    timestamp = datetime.datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
-    msg = f"[{timestamp}] {message}"
-    print(msg)
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(msg + "\n")
+# Concurrency and retry policy for the page fetches (all against mi.tv)
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_SECOND = 10
+MAX_CONNECTIONS = 16
+REQUEST_TIMEOUT = 15
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = {502, 503, 504}
+
+# On-disk cache of fetched pages, so re-runs within a few minutes skip mi.tv.
+# Entries never outlive midnight in SITE_TIMEZONE, when "today"/"tomorrow" roll over.
+CACHE_NAME = "epg_cache"
+CACHE_TTL = 600
+
+# Log records held in memory before they're written out (warnings flush early)
+LOG_BUFFER_CAPACITY = 1024
+
+logger = logging.getLogger("epg_scraper")
+
+def _local_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, TIMEZONE).timetuple()
+
+def setup_logging(buffered=True):
+    """
+    Sends the logger to the log file and console as "[timestamp] message".
+    The main process buffers records and writes them out in batches; parse
+    workers (buffered=False) write straight through, since they never flush.
+    """
+    formatter = logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+    formatter.converter = _local_time
+
+    # Drop handlers (and buffered records) a forked worker inherits
+    logger.handlers.clear()
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for handler in (logging.StreamHandler(sys.stdout), logging.FileHandler(LOG_FILE, encoding="utf-8", delay=True)):
+        handler.setFormatter(formatter)
+        if buffered:
+            handler = MemoryHandler(LOG_BUFFER_CAPACITY, flushLevel=logging.WARNING, target=handler)
+        logger.addHandler(handler)
+
+def flush_log():
+    """Writes out any buffered log records."""
+    for handler in logger.handlers:
+        handler.flush()
+
+class RateLimiter:
+    """Spaces request starts so at most `rate` go out per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def fetch_html(session, semaphore, limiter, url):
+    """Fetches a URL and returns its raw HTML bytes, or None on failure."""
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            await limiter.wait()
+            async with semaphore:
+                async with session.get(url) as response:
+                    if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                        response.raise_for_status()
+                        # Lexbor parses UTF-8 bytes directly, skip decoding to str
+                        return await response.read()
+            # Back off without holding a slot, other requests keep flowing
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    except Exception as e:
+        logger.error(f"ERROR fetching {url}: {e}")
+        return None
 
-def get_soup(url):
-    """Fetches a URL and returns a BeautifulSoup object."""
+async def fetch_and_parse(session, semaphore, limiter, pool, url, want_name):
+    """Fetches a page and parses it in the process pool as soon as it arrives."""
+    html = await fetch_html(session, semaphore, limiter, url)
+    # Parse off the event loop so other pages keep downloading meanwhile
+    loop = asyncio.get_running_loop()
     try:
-        response = requests.get(url, headers=HEADERS, timeout=15)
-        response.raise_for_status()
-        return BeautifulSoup(response.text, 'html.parser')
+        return await loop.run_in_executor(pool, parse_html, html, want_name)
     except Exception as e:
-        log(f"ERROR fetching {url}: {e}")
+        # A bad page (or a dead worker) only loses this page, like a failed fetch
+        logger.error(f"ERROR parsing {url}: {e}")
+        return None, []
+
+async def fetch_batch(session, semaphore, limiter, pool, jobs, parsed):
+    """Fetches and parses a batch of (slug, day) pages into parsed[slug][day]."""
+    pages = await asyncio.gather(*(
+        # main() only uses the channel name from the today page
+        fetch_and_parse(session, semaphore, limiter, pool, URL_TEMPLATES[day].format(slug=slug), day == "today")
+        for slug, day in jobs
+    ))
+    for (slug, day), page in zip(jobs, pages):
+        parsed[slug][day] = page
+
+async def fetch_all_pages(channels, pool):
+    """
+    Fetches every page the channels need over one session, as two batches:
+    today/tomorrow for all channels, then yesterday only where today's
+    listing doesn't already start at 00:00 (it only supplies today's shows
+    before the first one on today's page).
+    Returns {slug: {day: (channel_name, schedule_items)}}.
+    """
+    parsed = {slug: {} for slug in channels}
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(MAX_REQUESTS_PER_SECOND)
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    # No cache_control: a server Cache-Control/Expires header must not outlast the midnight cap
+    cache = SQLiteBackend(CACHE_NAME, expire_after=cache_ttl())
+    async with CachedSession(cache=cache, headers=HEADERS, connector=connector, timeout=timeout) as session:
+        await session.cache.delete_expired_responses()
+        jobs = [(slug, day) for slug in channels for day in ("today", "tomorrow")]
+        await fetch_batch(session, semaphore, limiter, pool, jobs, parsed)
+
+        jobs = [(slug, "yesterday") for slug in channels if not starts_at_midnight(parsed[slug]["today"][1])]
+        await fetch_batch(session, semaphore, limiter, pool, jobs, parsed)
+    return parsed
+
+def cache_ttl():
+    """Seconds a fetched page may be served from cache: CACHE_TTL, cut short at the site's midnight."""
+    now = datetime.datetime.now(SITE_TIMEZONE)
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(), tzinfo=SITE_TIMEZONE)
+    return max(1, min(CACHE_TTL, int((midnight - now).total_seconds())))
+
+# Every per-broadcast field parse_page reads, matched in one pass over each <li>
+ITEM_FIELDS_SELECTOR = "h2, span.time, span.sub-title, p.synopsis, div.image"
+
+def parse_hhmm(text):
+    """"HH:MM" -> minutes since midnight."""
+    hour, _, minute = text.partition(":")
+    return int(hour) * 60 + int(minute)
+
+def format_hhmm(minutes):
+    """Minutes since midnight -> "HH:MM" ("" for None)."""
+    if minutes is None:
+        return ""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+@dataclass(slots=True)
+class Program:
+    """One broadcast, with times held as minutes since midnight until it's serialised."""
+    show_name: str
+    show_logo: str
+    show_category: str
+    start_minutes: int
+    end_minutes: int | None = None
+    episode_description: str = ""
+
+    def to_json(self):
+        """The JSON object written for this show, times back in "HH:MM"."""
+        return {
+            "show_name": self.show_name,
+            "show_logo": self.show_logo,
+            "show_category": self.show_category,
+            "start_time": format_hhmm(self.start_minutes),
+            "end_time": format_hhmm(self.end_minutes),
+            "episode_description": self.episode_description
+        }
+
+def _json_default(obj):
+    if isinstance(obj, Program):
+        return obj.to_json()
+    raise TypeError
+
+def get_tree(html):
+    """Returns a parsed HTML tree for fetched HTML (None if the fetch failed)."""
+    if html is None:
         return None
+    return LexborHTMLParser(html)
+
+def parse_html(html, want_name=True):
+    """Parses fetched HTML bytes (or None) into (channel_name, schedule_items); runs in the worker process."""
+    return parse_page(get_tree(html), want_name)
 
-def parse_page(soup):
+def parse_page(tree, want_name=True):
     """
-    Parses a single HTML page into a list of show dictionaries.
-    Also extracts the channel display name.
+    Parses a single HTML page into a list of Program entries.
+    Also extracts the channel display name (None when want_name is False).
     """
-    if not soup:
+    if tree is None:
         return None, []
 
     # 1. Extract Channel Name
-    channel_name = "Unknown"
-    info_div = soup.find("div", class_="channel-info")
+    channel_name = "Unknown" if want_name else None
+    info_div = tree.css_first("div.channel-info") if want_name else None
     if info_div:
-        img_tag = info_div.find("img")
-        if img_tag and img_tag.get("title"):
-            channel_name = img_tag.get("title")
+        img_tag = info_div.css_first("img")
+        if img_tag and img_tag.attributes.get("title"):
+            channel_name = img_tag.attributes.get("title")
 
     # 2. Extract Broadcasts
     schedule_items = []
-    ul = soup.find("ul", class_="broadcasts")
+    ul = tree.css_first("ul.broadcasts")
     if not ul:
         return channel_name, []
 
-    lis = ul.find_all("li")
+    lis = ul.css("li")
     for li in lis:
         try:
+            # One selector pass per item, dispatched on tag/class; first match wins
+            fields = {}
+            for node in li.css(ITEM_FIELDS_SELECTOR):
+                tag = node.tag
+                if tag == "span":
+                    classes = (node.attributes.get("class") or "").split()
+                    field = "time" if "time" in classes else "sub-title"
+                else:
+                    field = tag
+                if field not in fields:
+                    fields[field] = node
+
             # Show Name
-            h2 = li.find("h2")
-            show_name = h2.get_text(strip=True) if h2 else ""
+            h2 = fields.get("h2")
+            show_name = h2.text(strip=True) if h2 else ""
 
             # Time
-            time_span = li.find("span", class_="time")
-            start_time = time_span.get_text(strip=True) if time_span else ""
+            time_span = fields.get("time")
+            start_time = time_span.text(strip=True) if time_span else ""
 
             # Category
-            sub_title = li.find("span", class_="sub-title")
-            category = sub_title.get_text(strip=True) if sub_title else ""
+            sub_title = fields.get("sub-title")
+            category = sub_title.text(strip=True) if sub_title else ""
 
             # Description
-            p_synopsis = li.find("p", class_="synopsis")
-            desc = p_synopsis.get_text(strip=True) if p_synopsis else ""
+            p_synopsis = fields.get("p")
+            desc = p_synopsis.text(strip=True) if p_synopsis else ""
 
             # Logo (extracted from style="background-image: url('...')")
             logo_url = ""
-            img_div = li.find("div", class_="image")
-            if img_div and img_div.has_attr("style"):
-                style_text = img_div["style"]
-                # Regex to extract url inside parenthesis
-                match = re.search(r"url\('?(.*?)'?\)", style_text)
-                if match:
-                    logo_url = match.group(1)
+            img_div = fields.get("div")
+            style_text = img_div.attributes.get("style") if img_div else None
+            if style_text:
+                # Slice out the url inside parenthesis
+                start = style_text.find("url(")
+                if start != -1:
+                    end = style_text.find(")", start + 4)
+                    if end != -1:
+                        logo_url = style_text[start + 4:end].strip(" '\"")
 
             if start_time and show_name:
-                schedule_items.append({
-                    "show_name": show_name,
-                    "show_logo": logo_url,
-                    "show_category": category,
-                    "start_time": start_time,
-                    "end_time": "", # Will calculate later
-                    "episode_description": desc
-                })
+                # end time is left empty and calculated later
+                schedule_items.append(Program(show_name, logo_url, category, parse_hhmm(start_time), episode_description=desc))
 
         except Exception as e:
-            log(f"Warning: Failed to parse a list item: {e}")
+            logger.warning(f"Warning: Failed to parse a list item: {e}")
             continue
 
     return channel_name, schedule_items
@@ -123,19 +308,13 @@ def split_schedule_at_midnight(schedule_list):
     split_index = len(schedule_list)
 
     for i in range(1, len(schedule_list)):
-        prev_time_str = schedule_list[i-1]['start_time']
-        curr_time_str = schedule_list[i]['start_time']
+        prev_hour = schedule_list[i-1].start_minutes // 60
+        curr_hour = schedule_list[i].start_minutes // 60
 
-        try:
-            prev_hour = int(prev_time_str.split(':')[0])
-            curr_hour = int(curr_time_str.split(':')[0])
-
-            # If current hour is significantly smaller than previous, we crossed midnight
-            if curr_hour < prev_hour:
-                split_index = i
-                break
-        except:
-            continue
+        # If current hour is significantly smaller than previous, we crossed midnight
+        if curr_hour < prev_hour:
+            split_index = i
+            break
 
     part_1 = schedule_list[:split_index]
     part_2 = schedule_list[split_index:]
@@ -143,45 +322,73 @@ def split_schedule_at_midnight(schedule_list):
 
 def calculate_end_times(current_day_list, next_day_first_item=None):
     """
-    Sets end_time = start_time of the NEXT show.
+    Sets end_minutes = start_minutes of the NEXT show.
     """
     for i in range(len(current_day_list)):
         if i < len(current_day_list) - 1:
-            current_day_list[i]['end_time'] = current_day_list[i+1]['start_time']
+            current_day_list[i].end_minutes = current_day_list[i+1].start_minutes
         else:
             # It's the last show of the day
             if next_day_first_item:
-                current_day_list[i]['end_time'] = next_day_first_item['start_time']
+                current_day_list[i].end_minutes = next_day_first_item.start_minutes
             else:
                 # Fallback if we don't have tomorrow's data (shouldn't happen with our logic)
-                current_day_list[i]['end_time'] = "" 
+                current_day_list[i].end_minutes = None
     return current_day_list
 
-def save_json(folder, filename, channel_name, date_str, schedule_data):
-    """Saves the data to a JSON file."""
-    path = os.path.join(OUTPUT_DIR, folder)
-    os.makedirs(path, exist_ok=True)
+def starts_at_midnight(schedule_list):
+    """True if a listing already begins at 00:00, so the previous day has nothing to add."""
+    return bool(schedule_list) and schedule_list[0].start_minutes == 0
 
-    file_path = os.path.join(path, f"{filename}.json")
+# Output folders already created this run, so each save skips the mkdir
+_CREATED_DIRS = set()
 
+def write_json(folder, file_path, data):
+    """Writes data as indented JSON to file_path, creating folder on first use."""
+    if folder not in _CREATED_DIRS:
+        os.makedirs(folder, exist_ok=True)
+        _CREATED_DIRS.add(folder)
+
+    # Re-scrapable output, a plain write without fsync is enough
+    # Programs go through _json_default so their times are written as "HH:MM"
+    option = orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATACLASS
+    Path(file_path).write_bytes(orjson.dumps(data, default=_json_default, option=option))
+    logger.info(f"Saved: {file_path}")
+
+def save_json(folder, filename, channel_name, date_str, schedule_data, combined=None):
+    """
+    Saves the data to schedule/<folder>/<filename>.json. With a `combined`
+    dict it's collected under combined[folder][filename] instead, for
+    save_combined() to write out.
+    """
     final_json = {
         "channel": channel_name,
         "date": date_str,
         "schedule": schedule_data
     }
 
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(final_json, f, ensure_ascii=False, indent=2)
-    log(f"Saved: {file_path}")
+    if combined is not None:
+        combined.setdefault(folder, {})[filename] = final_json
+        return
+
+    path = os.path.join(OUTPUT_DIR, folder)
+    write_json(path, os.path.join(path, f"{filename}.json"), final_json)
+
+def save_combined(combined):
+    """Writes each folder's collected channels to one schedule/<folder>.json, keyed by slug."""
+    for folder, channels in combined.items():
+        write_json(OUTPUT_DIR, os.path.join(OUTPUT_DIR, f"{folder}.json"), channels)
 
 # --- MAIN EXECUTION ---
-def main():
+def main(combined=False):
     # clear log file
     with open(LOG_FILE, "w") as f:
         f.write(f"Starting Scraper run at {datetime.datetime.now(TIMEZONE)}\n")
+    setup_logging()
 
     if not os.path.exists(CHANNEL_FILE):
-        log(f"Error: {CHANNEL_FILE} not found.")
+        logger.error(f"Error: {CHANNEL_FILE} not found.")
+        flush_log()
         return
 
     with open(CHANNEL_FILE, "r") as f:
@@ -194,18 +401,20 @@ def main():
     date_str_today = today_dt.strftime("%d/%m/%Y")
     date_str_tomorrow = tomorrow_dt.strftime("%d/%m/%Y")
 
-    for slug in channels:
-        log(f"Processing channel: {slug}")
+    # Channels collected per day when writing one combined file per day
+    combined_days = {} if combined else None
+
+    # 1. Fetch and parse every page up front
+    with ProcessPoolExecutor(initializer=setup_logging, initargs=(False,)) as pool:
+        parsed = asyncio.run(fetch_all_pages(channels, pool))
 
-        # 1. Fetch all 3 pages
-        soup_yest = get_soup(URL_TEMPLATES["yesterday"].format(slug=slug))
-        soup_today = get_soup(URL_TEMPLATES["today"].format(slug=slug))
-        soup_tom = get_soup(URL_TEMPLATES["tomorrow"].format(slug=slug))
+    for slug in channels:
+        logger.info(f"Processing channel: {slug}")
 
         # 2. Parse raw lists
-        name_y, list_y = parse_page(soup_yest)
-        name_t, list_t = parse_page(soup_today)
-        name_tm, list_tm = parse_page(soup_tom)
+        _, list_y = parsed[slug].get("yesterday", (None, []))
+        name_t, list_t = parsed[slug]["today"]
+        _, list_tm = parsed[slug]["tomorrow"]
 
         # Use the name found on the Today page as the definitive name
         channel_name = name_t if name_t != "Unknown" else slug
@@ -238,16 +447,25 @@ def main():
 
         # 5. Save Files
         if full_today_schedule:
-            save_json("today", slug, channel_name, date_str_today, full_today_schedule)
+            save_json("today", slug, channel_name, date_str_today, full_today_schedule, combined_days)
         else:
-            log(f"Warning: No schedule found for {slug} (Today)")
+            logger.warning(f"Warning: No schedule found for {slug} (Today)")
 
         if full_tomorrow_schedule:
-            save_json("tomorrow", slug, channel_name, date_str_tomorrow, full_tomorrow_schedule)
+            save_json("tomorrow", slug, channel_name, date_str_tomorrow, full_tomorrow_schedule, combined_days)
         else:
-            log(f"Warning: No schedule found for {slug} (Tomorrow)")
+            logger.warning(f"Warning: No schedule found for {slug} (Tomorrow)")
+
+    if combined_days is not None:
+        save_combined(combined_days)
 
-    log("Scraper finished.")
+    logger.info("Scraper finished.")
+    flush_log()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Scrape mi.tv schedules into schedule/today and schedule/tomorrow.")
+    parser.add_argument(
+        "--combined", action="store_true",
+        help="write one schedule/today.json and schedule/tomorrow.json keyed by channel "
+             "instead of a file per channel (the image downloader and deploy expect per-channel files)")
+    main(combined=parser.parse_args().combined)
@@ -1,10 +1,14 @@
 import os
 import gzip
-import json
+import zlib
+import bisect
+import heapq
+import orjson
 import requests
+from io import BytesIO
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta, time
-import pytz
+from datetime import datetime, timedelta, time, timezone
+from zoneinfo import ZoneInfo
 import re
 
 # --- Configuration ---
@@ -16,125 +20,163 @@ OUTPUT_DIR_TODAY = "schedule/today"
 OUTPUT_DIR_TOMORROW = "schedule/tomorrow"
 
 # Set Target Timezone to Mexico City
-TZ_MEXICO = pytz.timezone('America/Mexico_City')
+TZ_MEXICO = ZoneInfo('America/Mexico_City')
 
-def get_xml_root(url):
+# Patterns used per channel / per saved file
+_CANAL_PREFIX_RE = re.compile(r'^Canal\s+', re.IGNORECASE)
+_NON_ALNUM_RE = re.compile(r'[^a-zA-Z0-9]')
+_DASHES_RE = re.compile(r'-+')
+
+# Feeds only use a handful of distinct offsets, build each timezone once
+_OFFSET_CACHE = {}
+
+# What a failed download or a corrupt/truncated feed raises while streaming
+_FEED_ERRORS = (requests.RequestException, ET.ParseError, OSError, EOFError, zlib.error)
+
+def iter_xml_elements(url):
     """
-    Downloads and parses XML from a URL (handles .gz and raw .xml).
+    Downloads an XMLTV feed (handles .gz and raw .xml) and stream-parses it.
+    Yields each top-level <channel>/<programme> element once it is complete;
+    elements are freed after the caller is done with them.
+    Download/decompression/parse errors (_FEED_ERRORS) are raised mid-stream,
+    so the caller must discard whatever the feed yielded before the error.
     """
-    try:
-        print(f"Downloading: {url}")
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        
-        content = response.content
-        
-        # Check if it is gzipped (Magic number 1f 8b) or URL ends in .gz
-        if url.endswith('.gz') or content[:2] == b'\x1f\x8b':
-            try:
-                content = gzip.decompress(content)
-            except OSError:
-                print("Warning: Failed to decompress. Trying as plain text.")
-        
-        return ET.fromstring(content)
-    except Exception as e:
-        print(f"Error processing {url}: {e}")
-        return None
+    print(f"Downloading: {url}")
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    content = response.content
+
+    stream = BytesIO(content)
+    
+    # Check if it is gzipped (Magic number 1f 8b) or URL ends in .gz
+    if content[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    elif url.endswith('.gz'):
+        print("Warning: Failed to decompress. Trying as plain text.")
+
+    print("Parsing XML data...")
+    context = ET.iterparse(stream, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag in ("channel", "programme"):
+            yield elem
+            # Drop everything parsed so far so the tree never builds up
+            root.clear()
 
 def parse_xmltv_date(date_str):
     """
     Parses XMLTV date format: YYYYMMDDHHMMSS +/-HHMM
     Returns a datetime object in UTC (or timezone aware).
     """
-    if not date_str:
+    if not date_str or len(date_str) < 14 or not date_str[:14].isdigit():
         return None
     
-    # Remove space before timezone if present for both + and - offsets
-    date_str = date_str.replace(" +", "+").replace(" -", "-")
+    # Timezone may be separated by a space for both + and - offsets
+    offset = date_str[14:].strip().replace(":", "")
+    tz = _OFFSET_CACHE.get(offset)
+    if tz is None:
+        if len(offset) != 5 or offset[0] not in "+-" or not offset[1:].isdigit():
+            return None
+        delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        tz = timezone(-delta if offset[0] == "-" else delta)
+        _OFFSET_CACHE[offset] = tz
     
     try:
-        dt = datetime.strptime(date_str, "%Y%m%d%H%M%S%z")
-        return dt
+        return datetime(
+            int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]),
+            int(date_str[8:10]), int(date_str[10:12]), int(date_str[12:14]),
+            tzinfo=tz,
+        )
     except ValueError:
         return None
 
 def sanitize_filename(name):
     """Converts 'Sky Serie' to 'Sky-Serie' and removes illegal chars"""
-    clean_name = re.sub(r'[^a-zA-Z0-9]', '-', name).strip('-')
+    clean_name = _NON_ALNUM_RE.sub('-', name).strip('-')
     # Collapse multiple hyphens into one
-    clean_name = re.sub(r'-+', '-', clean_name)
+    clean_name = _DASHES_RE.sub('-', clean_name)
     return clean_name
 
+def _start_key(program):
+    return program['start_dt']
+
 def extract_schedule():
-    # Prepare data structure: { 'Channel Name': [list of programs] }
+    # Prepare data structure: { 'Channel Name': [one sorted program list per feed] }
     all_extracted_data = {}
     
     # Iterate over all URLs
     for url in EPG_URLS:
-        root = get_xml_root(url)
-        if root is None:
-            continue
-            
-        print("Parsing XML data...")
-
         # 1. Map Channel IDs to Display Names from the XML itself
         channel_id_map = {} 
+        feed_data = {}
+        count_progs = 0
         
-        for channel in root.findall('channel'):
-            c_id = channel.get('id')
-            display_name = channel.find('display-name')
-            
-            # Use display name if available, otherwise fallback to ID
-            c_name = display_name.text if display_name is not None else c_id
-            
-            # Remove 'Canal ' prefix if present (Case Insensitive)
-            if c_name:
-                c_name = re.sub(r'^Canal\s+', '', c_name, flags=re.IGNORECASE)
-            
-            if c_id:
-                channel_id_map[c_id] = c_name
-
-        print(f"Found {len(channel_id_map)} channels in XML.")
+        # Only keep a feed that parsed to the end, a truncated one would
+        # overwrite good schedules with partial ones
+        try:
+            for elem in iter_xml_elements(url):
+                if elem.tag == 'channel':
+                    c_id = elem.get('id')
+                    display_name = elem.find('display-name')
+                
+                    # Use display name if available, otherwise fallback to ID
+                    c_name = display_name.text if display_name is not None else c_id
+                
+                    # Remove 'Canal ' prefix if present (Case Insensitive)
+                    if c_name:
+                        c_name = _CANAL_PREFIX_RE.sub('', c_name)
+                
+                    if c_id:
+                        channel_id_map[c_id] = c_name
+                    continue
 
-        # 2. Parse Programmes
-        count_progs = 0
-        for prog in root.findall('programme'):
-            channel_id = prog.get('channel')
+                # 2. Parse Programmes (XMLTV lists all channels before programmes)
+                prog = elem
+                channel_id = prog.get('channel')
             
-            # Only process if we know the channel name
-            if channel_id in channel_id_map:
-                channel_name_clean = channel_id_map[channel_id]
+                # Only process if we know the channel name
+                if channel_id in channel_id_map:
+                    channel_name_clean = channel_id_map[channel_id]
                 
-                start_raw = parse_xmltv_date(prog.get('start'))
-                stop_raw = parse_xmltv_date(prog.get('stop'))
+                    start_raw = parse_xmltv_date(prog.get('start'))
+                    stop_raw = parse_xmltv_date(prog.get('stop'))
                 
-                if not start_raw or not stop_raw:
-                    continue
+                    if not start_raw or not stop_raw:
+                        continue
 
-                # Convert to Mexico City Time
-                start_mx = start_raw.astimezone(TZ_MEXICO)
-                stop_mx = stop_raw.astimezone(TZ_MEXICO)
+                    # Convert to Mexico City Time
+                    start_mx = start_raw.astimezone(TZ_MEXICO)
+                    stop_mx = stop_raw.astimezone(TZ_MEXICO)
                 
-                # Extract Metadata
-                title_el = prog.find('title')
-                desc_el = prog.find('desc')
-                cat_el = prog.find('category')
-                icon_el = prog.find('icon')
+                    # Extract Metadata
+                    title_el = prog.find('title')
+                    desc_el = prog.find('desc')
+                    cat_el = prog.find('category')
+                    icon_el = prog.find('icon')
                 
-                program_data = {
-                    "show_name": title_el.text if title_el is not None else "No Title",
-                    "description": desc_el.text if desc_el is not None else "",
-                    "category": cat_el.text if cat_el is not None else "",
-                    "start_dt": start_mx, 
-                    "end_dt": stop_mx,
-                    "logo_url": icon_el.get('src') if icon_el is not None else ""
-                }
+                    program_data = {
+                        "show_name": title_el.text if title_el is not None else "No Title",
+                        "description": desc_el.text if desc_el is not None else "",
+                        "category": cat_el.text if cat_el is not None else "",
+                        "start_dt": start_mx, 
+                        "end_dt": stop_mx,
+                        "logo_url": icon_el.get('src') if icon_el is not None else ""
+                    }
                 
-                if channel_name_clean not in all_extracted_data:
-                    all_extracted_data[channel_name_clean] = []
-                all_extracted_data[channel_name_clean].append(program_data)
-                count_progs += 1
+                    if channel_name_clean not in feed_data:
+                        feed_data[channel_name_clean] = []
+                    feed_data[channel_name_clean].append(program_data)
+                    count_progs += 1
+        except _FEED_ERRORS as e:
+            print(f"Error processing {url}: {e}")
+            continue
         
+        # Feeds list a channel's programmes in order, so this sort is ~linear
+        for ch_name, programs in feed_data.items():
+            programs.sort(key=_start_key)
+            all_extracted_data.setdefault(ch_name, []).append(programs)
+        
+        print(f"Found {len(channel_id_map)} channels in XML.")
         print(f"Extracted {count_progs} programs.")
 
     # 3. Process and Save Data
@@ -148,18 +190,34 @@ def extract_schedule():
     
     print(f"Saving schedules for {today_date} and {tomorrow_date}...")
 
+    # Day bounds and the date label only depend on the date, build them once for all channels
+    day_windows = []
+    for target_date, folder in [(today_date, OUTPUT_DIR_TODAY), (tomorrow_date, OUTPUT_DIR_TOMORROW)]:
+        day_start = datetime.combine(target_date, time.min, tzinfo=TZ_MEXICO)
+        day_end = datetime.combine(target_date, time.max, tzinfo=TZ_MEXICO)
+        # CHANGED: Date format to DD/MM/YYYY
+        date_str = target_date.strftime("%d/%m/%Y")
+        day_windows.append((folder, day_start, day_end, date_str))
+
     files_saved = 0
-    for ch_name, programs in all_extracted_data.items():
-        # Sort programs by start time
-        programs.sort(key=lambda x: x['start_dt'])
+    for ch_name, streams in all_extracted_data.items():
+        # Merge the per-feed lists by start time; merge() is stable, so equal
+        # starts keep feed order exactly as sorting the pooled list did
+        programs = list(heapq.merge(*streams, key=_start_key))
+        starts = [p['start_dt'] for p in programs]
+        
+        # Anything starting earlier than this before midnight can't reach the day
+        max_duration = max((p['end_dt'] - p['start_dt'] for p in programs), default=timedelta(0))
+        max_duration = max(max_duration, timedelta(0))
         
-        for target_date, folder in [(today_date, OUTPUT_DIR_TODAY), (tomorrow_date, OUTPUT_DIR_TOMORROW)]:
+        for folder, day_start, day_end, date_str in day_windows:
             daily_schedule = []
             
-            day_start = TZ_MEXICO.localize(datetime.combine(target_date, time.min))
-            day_end = TZ_MEXICO.localize(datetime.combine(target_date, time.max))
+            # Only scan the programs whose start falls in the window that can overlap
+            lo = bisect.bisect_left(starts, day_start - max_duration)
+            hi = bisect.bisect_right(starts, day_end)
             
-            for p in programs:
+            for p in programs[lo:hi]:
                 p_start = p['start_dt']
                 p_end = p['end_dt']
                 
@@ -169,25 +227,20 @@ def extract_schedule():
                         display_start = day_start
                     
                     # CHANGED: Format to HH:MM only
-                    fmt_time = "%H:%M"
-                    
                     entry = {
                         "show_name": p['show_name'],
                         "show_logo": p['logo_url'],
                         "show_category": p['category'],
-                        "start_time": display_start.strftime(fmt_time),
-                        "end_time": p_end.strftime(fmt_time),
+                        "start_time": f"{display_start.hour:02d}:{display_start.minute:02d}",
+                        "end_time": f"{p_end.hour:02d}:{p_end.minute:02d}",
                         "episode_description": p['description']
                     }
                     daily_schedule.append(entry)
             
             if daily_schedule:
-                # CHANGED: Date format to DD/MM/YYYY
-                fmt_date = "%d/%m/%Y"
-                
                 json_output = {
                     "channel": ch_name, # Renamed key
-                    "date": target_date.strftime(fmt_date),
+                    "date": date_str,
                     "schedule": daily_schedule # Renamed key
                 }
                 
@@ -195,8 +248,8 @@ def extract_schedule():
                 file_path = os.path.join(folder, filename)
                 
                 try:
-                    with open(file_path, 'w', encoding='utf-8') as f:
-                        json.dump(json_output, f, indent=2, ensure_ascii=False)
+                    with open(file_path, 'wb') as f:
+                        f.write(orjson.dumps(json_output, option=orjson.OPT_INDENT_2))
                     files_saved += 1
                 except OSError as e:
                     print(f"Error saving file for {ch_name}: {e}")